@@ -1,28 +1,41 @@
 """
-Содержит функцию get_db_connection для подключения к базе данных.
+Содержит функции для работы с пулом соединений к базе данных:
+- get_db_connection: выдает соединение из пула, создавая пул при первом обращении.
+- release_db_connection: возвращает соединение обратно в пул для переиспользования.
 
 """
 import logging
-import psycopg2
+from psycopg2 import pool
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from config.user_pass import DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
 
+# Пулы соединений по имени базы данных, создаются лениво
+_POOLS = {}
 
-def get_db_connection(DB_NAME):
-    """Подключение к бд"""
-    # DB_USER, DB_PASSWORD от рута к postgres
-    if None in [DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME]:
-        logging.error('Одна или несколько переменных окружения не установлены')
-        raise ValueError('Неверные параметры подключения к базе данных')
 
-    try:
-        connection = psycopg2.connect(
+def _get_pool(DB_NAME):
+    """Ленивое создание пула соединений для бд"""
+    if DB_NAME not in _POOLS:
+        _POOLS[DB_NAME] = pool.ThreadedConnectionPool(
+            1, 4,
             user=DB_USER,
             password=DB_PASSWORD,
             host=DB_HOST,
             port=DB_PORT,
             dbname=DB_NAME
         )
+    return _POOLS[DB_NAME]
+
+
+def get_db_connection(DB_NAME):
+    """Получение соединения с бд из пула"""
+    # DB_USER, DB_PASSWORD от рута к postgres
+    if None in [DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME]:
+        logging.error('Одна или несколько переменных окружения не установлены')
+        raise ValueError('Неверные параметры подключения к базе данных')
+
+    try:
+        connection = _get_pool(DB_NAME).getconn()
         connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         logging.info('Подключение к базе успешно установлено')
         return connection
@@ -30,3 +43,11 @@ def get_db_connection(DB_NAME):
     except Exception as e:
         logging.error('Ошибка подключения к базе данных: %s', e)
         raise
+
+
+def release_db_connection(connection, DB_NAME='sberdb'):
+    """Возврат соединения в пул"""
+    if DB_NAME in _POOLS:
+        _POOLS[DB_NAME].putconn(connection)
+    else:
+        connection.close()
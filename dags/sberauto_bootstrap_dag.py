@@ -0,0 +1,48 @@
+"""
+Модуль sberauto_bootstrap_dag.py - это Airflow DAG одноразового развертывания схемы.
+
+DAG запускается один раз (schedule='@once') и выполняет функцию bootstrap_schema
+из модуля create_tables: создает базу данных sberdb и таблицы sessions и hits
+с индексами. Ежедневный sberauto_dag схему не создает, а только проверяет
+ее наличие и падает с понятной ошибкой, если bootstrap еще не выполнялся.
+
+"""
+import os
+import sys
+import datetime as dt
+
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+
+
+# Укажем путь к проекту
+project_path = os.path.expanduser('~/Projects/diploma')
+
+# Добавим путь к коду проекта в переменную окружения, чтобы он был доступен python-процессу
+os.environ['PROJECT_PATH'] = project_path
+
+# Добавим путь к проекту в системные переменные
+sys.path.insert(0, project_path)
+
+from modules.create_tables import bootstrap_schema
+
+default_args = {
+    'owner': 'temeka',
+    'depends_on_past': False,
+    'start_date': dt.datetime(2024, 10, 10),
+    'retries': 1,
+    'retry_delay': dt.timedelta(minutes=5),
+}
+
+with DAG(
+        dag_id='sberauto_bootstrap_dag',
+        schedule='@once',
+        default_args=default_args,
+        max_active_runs=1,
+
+) as dag:
+    task_bootstrap_schema = PythonOperator(
+        task_id='bootstrap_schema',
+        python_callable=bootstrap_schema,
+        dag=dag,
+    )
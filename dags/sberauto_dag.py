@@ -2,11 +2,18 @@
 Модуль sberauto_dag.py - это Airflow DAG, который описывает порядок выполнения задач.
 
 В этом модуле мы создаем DAG, который будет запускаться каждый день в 12:00.
-В DAG мы добавили 2 задачи:
-- insert_data: выполнит функцию insert_data из модуля data_pipeline, которая загрузит данные
-    из файлов json_data в таблицы hits и sessions.
-- process_and_load_json_data: выполнит функцию process_and_load_json_data из модуля json_to_db,
-    которая обработает данные из файлов json_data и загрузит их в базу данных.
+Задачи в DAG:
+- process_data: выполнит функцию insert_data из модуля data_pipeline, которая загрузит данные
+    из файлов выгрузок в таблицы hits и sessions.
+- list_sessions_files / list_hits_files: соберут списки json-файлов с сессиями и хитами.
+- process_json_sessions / process_json_hits: динамически замапленные задачи,
+    загружающие каждый json-файл отдельной параллельной задачей
+    через process_one_json_file из модуля json_to_db.
+
+Файлы с сессиями загружаются раньше файлов с хитами, чтобы хиты не потеряли
+свои сессии; process_data и загрузка сессий из json идут параллельно.
+Конкурентный доступ к базе ограничен пулом Airflow 'db_pool'
+(создается командой: airflow pools set db_pool 4 "Лимит соединений к бд").
 
 В параметрах DAG мы указали владельца, дату начала выполнения, количество повторов,
     и время ожидания между повторами.
@@ -17,6 +24,7 @@ import sys
 import datetime as dt
 
 from airflow import DAG
+from airflow.decorators import task
 from airflow.operators.python import PythonOperator
 
 
@@ -30,7 +38,7 @@ os.environ['PROJECT_PATH'] = project_path
 sys.path.insert(0, project_path)
 
 from modules.data_pipeline import insert_data
-from modules.json_to_db import process_and_load_json_data
+from modules.json_to_db import process_one_json_file
 
 default_args = {
     'owner': 'temeka',
@@ -47,18 +55,35 @@ with DAG(
         max_active_runs=1,
 
 ) as dag:
+    @task
+    def list_json_files(name_part: str) -> list:
+        """Список json-файлов, содержащих name_part в имени"""
+        from glob import glob
+        return sorted(
+            f for f in glob(os.path.join(project_path, 'json_data', '*.json'))
+            if name_part in os.path.basename(f)
+        )
+
+    @task(pool='db_pool')
+    def load_json_file(filename: str) -> None:
+        """Загрузка одного json-файла в бд"""
+        process_one_json_file(filename)
+
     task_process_data = PythonOperator(
         task_id='process_data',
         python_callable=insert_data,
         dag=dag,
+        pool='db_pool',
         task_concurrency=1
     )
 
-    task_process_json = PythonOperator(
-        task_id='process_json',
-        python_callable=process_and_load_json_data,
-        dag=dag,
-        task_concurrency=1
-    )
+    sessions_files = list_json_files.override(task_id='list_sessions_files')('ga_sessions')
+    hits_files = list_json_files.override(task_id='list_hits_files')('ga_hits')
+
+    load_sessions = load_json_file.override(
+        task_id='process_json_sessions').expand(filename=sessions_files)
+    load_hits = load_json_file.override(
+        task_id='process_json_hits').expand(filename=hits_files)
 
-    task_process_data >> task_process_json
+    # Сессии (из пиклов и из json) должны попасть в базу раньше хитов
+    [task_process_data, load_sessions] >> load_hits
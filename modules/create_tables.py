@@ -2,16 +2,24 @@
 Модуль содержит функции, необходимые для создания базы данных и таблиц в ней.
 - create_tables: создает таблицы sessions и hits в базе данных, если они еще не существуют.
 - create_database_if_not_exists: проверяет наличие базы данных и создает ее в случае отсутствия.
+- bootstrap_schema: одноразовое развертывание бд и таблиц, вызывается bootstrap-DAG'ом.
+- check_schema_exists: быстрая проверка наличия таблиц перед загрузкой данных.
+- with_bulk_load_mode: контекстный менеджер, снимающий внешний ключ и индекс hits
+  на время массовой загрузки и восстанавливающий их после.
 - Используется библиотека psycopg2 для взаимодействия с базой данных PostgreSQL.
 - Конфигурационные параметры для подключения к базе данных импортируются из модуля user_pass.
 """
 import logging
 
+from contextlib import contextmanager
+
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_INERROR
 from config.user_pass import DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
 
+DB_NAME = 'sberdb'
+
 
 def create_tables(connection):
     """Создание таблиц в бд"""
@@ -62,6 +70,65 @@ def create_tables(connection):
         raise
 
 
+def bootstrap_schema():
+    """Одноразовое развертывание бд и таблиц (вызывается bootstrap-DAG'ом)"""
+    from config.db_config import get_db_connection, release_db_connection
+
+    create_database_if_not_exists()
+    connection = get_db_connection('sberdb')
+    try:
+        create_tables(connection)
+    finally:
+        release_db_connection(connection)
+
+
+def check_schema_exists(connection):
+    """Быстрая проверка, что схема уже развернута bootstrap-DAG'ом"""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM sessions LIMIT 0')
+            cursor.execute('SELECT 1 FROM hits LIMIT 0')
+    except Exception as e:
+        logging.error('Таблицы sessions/hits не найдены: %s', e)
+        raise RuntimeError(
+            'Схема базы данных не развернута: '
+            'сначала запустите sberauto_bootstrap_dag'
+        ) from e
+
+
+@contextmanager
+def with_bulk_load_mode(connection):
+    """Снятие внешнего ключа и индекса hits на время массовой загрузки
+
+    Поддержка индекса и построчная проверка внешнего ключа заметно
+    замедляют массовую вставку: дешевле убрать их перед загрузкой
+    и пересоздать одним проходом после.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE hits DROP CONSTRAINT IF EXISTS hits_session_id_fkey')
+        cursor.execute('DROP INDEX IF EXISTS idx_hits_hit_date')
+    try:
+        yield connection
+    finally:
+        # Коммитом управляет вызывающая сторона: вся загрузка
+        # выполняется одной транзакцией.
+        # В упавшей транзакции DDL выполнить нельзя - снятые ключ
+        # и индекс вернет откат самой транзакции
+        if connection.info.transaction_status != TRANSACTION_STATUS_INERROR:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    ALTER TABLE hits
+                    ADD CONSTRAINT hits_session_id_fkey
+                    FOREIGN KEY (session_id)
+                        REFERENCES sessions (session_id)
+                        ON DELETE CASCADE
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_hits_hit_date
+                    ON hits(hit_date)
+                """)
+
+
 def create_database_if_not_exists():
     """Создание бд, если она не существует"""
     try:
@@ -75,8 +142,10 @@ def create_database_if_not_exists():
         conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
 
         with conn.cursor() as cursor:
-            DB_NAME = 'sberdb'
-            cursor.execute(f"SELECT 1 FROM pg_catalog.pg_database WHERE datname = '{DB_NAME}'")
+            cursor.execute(
+                'SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s',
+                (DB_NAME,)
+            )
             exists = cursor.fetchone()
             if not exists:
                 cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(DB_NAME)))
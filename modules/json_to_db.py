@@ -2,140 +2,198 @@
 Этот модуль предназначен для обработки и загрузки данных в базу данных из JSON файлов.
 Он включает в себя функции для обработки данных сессий и хитов, а также их загрузки в базу данных.
 Функции в этом модуле:
-- process_sessions_data: Обрабатывает данные сессий из JSON и
-возвращает данные для загрузки и идентификаторы отсутствующих сессий.
-- process_hits_data: Обрабатывает данные хитов из JSON и возвращает отфильтрованный список хитов.
+- iter_json_records: Потоковая итерация по записям json-файла без загрузки его целиком в память.
+- process_sessions_data: Генератор кортежей сессий из потокового JSON для загрузки в базу данных.
+- process_hits_data: Генератор кортежей хитов из потокового JSON;
+фильтрация по существующим сессиям выполняется на стороне сервера.
+- process_one_json_file: Обрабатывает и загружает один JSON файл,
+используется для динамического маппинга задач в Airflow.
 - process_and_load_json_data: Основная функция,
 которая обрабатывает JSON файлы и загружает данные в базу данных.
 """
 
-import json
 import os
 import logging
 
-from datetime import datetime
+from datetime import date
 from glob import glob
 
-from config.db_config import get_db_connection
-from modules.create_tables import create_tables, create_database_if_not_exists
-from modules.data_pipeline import bulk_insert
+import ijson
 
-path = os.environ.get('PROJECT_PATH', '.')
-
-
-def process_sessions_data(data: dict) -> tuple[list, set]:
-    """Обработка данных сессий из json"""
-    session_data = []
-    missing_sessions_ids = set()
+from config.db_config import get_db_connection, release_db_connection
+from modules.create_tables import check_schema_exists, with_bulk_load_mode
+from modules.data_pipeline import copy_rows_to_stage
 
-    for _, sessions in data.items():
-        for session in sessions:
-            session_id = session['session_id']
-            utm_source = session.get('utm_source', 'unknown')
-            utm_medium = session.get('utm_medium', 'unknown')
-            visit_date = datetime.strptime(session['visit_date'], '%Y-%m-%d').date()
-            visit_number = session['visit_number']
-            device_os = session.get('device_os', 'unknown')
-            device_brand = session.get('device_brand', 'unknown') \
-                if session.get('device_brand') not in [None, 'NaN'] else 'unknown'
-            device_model = session.get('device_model', 'unknown') \
-                if session.get('device_model') not in [None, 'NaN'] else 'unknown'
-
-            session_data.append((
-                session_id, utm_source, utm_medium,
-                visit_date, visit_number,
-                device_os, device_brand, device_model
-            ))
+path = os.environ.get('PROJECT_PATH', '.')
 
-            missing_sessions_ids.add(session_id)
 
-    return session_data, missing_sessions_ids
+def _clean(value):
+    """Замена пустых значений на 'unknown'"""
+    return 'unknown' if value in (None, 'NaN') else value
+
+
+def iter_json_records(f):
+    """Потоковая итерация по записям всех массивов верхнего уровня json"""
+    builder = None
+    record_prefix = None
+    for prefix, event, value in ijson.parse(f):
+        if builder is not None:
+            builder.event(event, value)
+            # Сравниваем префикс целиком, чтобы не оборвать запись
+            # на end_map вложенного объекта
+            if event == 'end_map' and prefix == record_prefix:
+                yield builder.value
+                builder = None
+                record_prefix = None
+        elif event == 'start_map' and (prefix == 'item' or prefix.endswith('.item')):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            record_prefix = prefix
+
+
+def process_sessions_data(f):
+    """Генератор кортежей сессий из потокового json"""
+    for session in iter_json_records(f):
+        yield (
+            session['session_id'],
+            session.get('utm_source', 'unknown'),
+            session.get('utm_medium', 'unknown'),
+            date.fromisoformat(session['visit_date']),
+            session['visit_number'],
+            session.get('device_os', 'unknown'),
+            _clean(session.get('device_brand')),
+            _clean(session.get('device_model'))
+        )
+
+
+def process_hits_data(f):
+    """Генератор кортежей хитов из потокового json"""
+    for hit in iter_json_records(f):
+        yield (
+            hit['session_id'],
+            date.fromisoformat(hit['hit_date']),
+            hit['hit_number'],
+            hit['event_label']
+        )
+
+
+def _load_json_file(connection, filename: str) -> None:
+    """Загрузка одного json-файла в бд через открытое соединение"""
+    logging.info('Открываю файл: %s', filename)
+    with open(filename, 'rb') as f:
+        if 'ga_sessions' in filename:
+            # Загрузка сессий в бд через COPY в staging-таблицу
+            sessions_columns = (
+                'session_id', 'utm_source', 'utm_medium',
+                'visit_date', 'visit_number', 'device_os',
+                'device_brand', 'device_model'
+            )
+            with connection.cursor() as cursor:
+                sessions_stage = copy_rows_to_stage(
+                    cursor, process_sessions_data(f),
+                    'sessions', sessions_columns
+                )
+                cursor.execute(f"""
+                    INSERT INTO sessions ({', '.join(sessions_columns)})
+                    SELECT DISTINCT ON (session_id)
+                        {', '.join(sessions_columns)}
+                    FROM {sessions_stage}
+                    ON CONFLICT (session_id) DO UPDATE
+                    SET
+                        utm_source = EXCLUDED.utm_source,
+                        utm_medium = EXCLUDED.utm_medium,
+                        visit_date = EXCLUDED.visit_date,
+                        visit_number = EXCLUDED.visit_number,
+                        device_os = EXCLUDED.device_os,
+                        device_brand = EXCLUDED.device_brand,
+                        device_model = EXCLUDED.device_model
+                """)
+                cursor.execute(f'DROP TABLE {sessions_stage}')
+            logging.info('Сессии из %s загружены', filename)
+
+        elif 'ga_hits' in filename:
+            # Загрузка хитов в бд через COPY в staging-таблицу:
+            # фильтрация по существующим сессиям выполняется на сервере
+            hits_columns = ('session_id', 'hit_date', 'hit_number', 'event_label')
+            with connection.cursor() as cursor:
+                hits_stage = copy_rows_to_stage(
+                    cursor, process_hits_data(f),
+                    'hits', hits_columns
+                )
+                cursor.execute(f"""
+                    INSERT INTO hits ({', '.join(hits_columns)})
+                    SELECT DISTINCT ON (session_id, hit_number)
+                        {', '.join(hits_columns)}
+                    FROM {hits_stage} h
+                    WHERE EXISTS (
+                        SELECT 1 FROM sessions s
+                        WHERE s.session_id = h.session_id
+                    )
+                    ON CONFLICT (session_id, hit_number) DO UPDATE
+                    SET
+                        hit_date = EXCLUDED.hit_date,
+                        event_label = EXCLUDED.event_label
+                """)
+                cursor.execute(f'DROP TABLE {hits_stage}')
+            logging.info('Хиты из %s загружены', filename)
+
+
+def process_one_json_file(filename: str) -> None:
+    """Обработка и загрузка одного json-файла в бд (для маппинга задач Airflow)"""
+    connection = None
+    # Схема создается отдельным bootstrap-DAG'ом, здесь только проверяем
+    try:
+        connection = get_db_connection('sberdb')
+        check_schema_exists(connection)
 
+        # Один коммит на файл; при падении DAG просто перезапускается
+        connection.autocommit = False
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL synchronous_commit = off')
 
-def process_hits_data(data: dict, valid_sessions_ids: set) -> list:
-    """Обработка данных хитов из json"""
-    hits_data = []
-    for _, sessions in data.items():
-        for hit in sessions:
-            session_id = hit['session_id']
-            hit_date = datetime.strptime(hit['hit_date'], '%Y-%m-%d').date()
-            hit_number = hit['hit_number']
-            event_label = hit['event_label']
+        _load_json_file(connection, filename)
+        connection.commit()
 
-            if session_id in valid_sessions_ids:
-                hits_data.append((session_id, hit_date, hit_number, event_label))
+    except Exception as e:
+        logging.error('Произошла ошибка: %s', e)
+        if connection:
+            connection.rollback()
+        raise
 
-    return hits_data
+    finally:
+        if connection:
+            release_db_connection(connection)
 
 
 def process_and_load_json_data(data_dir=path + '/json_data') -> None:
     """Обработка и загрузка данных в бд из json"""
+    connection = None
+    # Схема создается отдельным bootstrap-DAG'ом, здесь только проверяем
     try:
         # Коннект к бд
-        create_database_if_not_exists()
         connection = get_db_connection('sberdb')
-        create_tables(connection)
-
-        # Обработка json
-        for filename in glob(os.path.join(data_dir, '*.json')):
-            logging.info('Открываю файл: %s', filename)
-            with open(filename, 'r') as f:
-                data = json.load(f)
-
-                if 'ga_sessions' in filename:
-                    sessions_data, missing_sessions_ids = process_sessions_data(data)
-                    logging.info(
-                        'Обработано %s сессий, найдено %s недостающих сессий',
-                        len(sessions_data), len(missing_sessions_ids)
-                    )
-                    # Загрузка сессий в бд
-                    insert_sessions_query = """
-                                    INSERT INTO sessions (
-                                        session_id, utm_source, utm_medium, 
-                                        visit_date, visit_number, device_os, 
-                                        device_brand, device_model
-                                    )
-                                    VALUES %s
-                                    ON CONFLICT (session_id) DO UPDATE
-                                    SET
-                                        utm_source = EXCLUDED.utm_source,
-                                        utm_medium = EXCLUDED.utm_medium,
-                                        visit_date = EXCLUDED.visit_date,
-                                        visit_number = EXCLUDED.visit_number,
-                                        device_os = EXCLUDED.device_os,
-                                        device_brand = EXCLUDED.device_brand,
-                                        device_model = EXCLUDED.device_model
-                    """
-                    bulk_insert(connection.cursor(), insert_sessions_query, sessions_data)
-                    connection.commit()
-
-                elif 'ga_hits' in filename:
-                    with connection.cursor() as cursor:
-                        cursor.execute('SELECT session_id FROM sessions')
-                        existing_sessions = set(row[0] for row in cursor.fetchall())
-
-                    hits_data = process_hits_data(data, existing_sessions)
-                    logging.info('Обработано %s хитов', len(hits_data))
-
-                    # Загрузка хитов в бд
-                    insert_hits_query = """
-                        INSERT INTO hits (session_id, hit_date, hit_number, event_label)
-                        VALUES %s
-                        ON CONFLICT (session_id, hit_number) DO UPDATE
-                        SET
-                            hit_date = EXCLUDED.hit_date,
-                            event_label = EXCLUDED.event_label
-                        
-                    """
-                    bulk_insert(connection.cursor(), insert_hits_query, hits_data)
-                    connection.commit()
-
-            logging.info('Обработка json завершена, все данные загружены')
+        check_schema_exists(connection)
+
+        # Вся загрузка идёт одной транзакцией с одним fsync в конце;
+        # при падении посреди загрузки DAG просто перезапускается
+        connection.autocommit = False
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL synchronous_commit = off')
+
+        # Обработка json: ключ и индекс hits снимаются один раз на весь прогон,
+        # а не на каждый файл
+        with with_bulk_load_mode(connection):
+            for filename in glob(os.path.join(data_dir, '*.json')):
+                _load_json_file(connection, filename)
+
+        connection.commit()
+        logging.info('Обработка json завершена, все данные загружены')
 
     except Exception as e:
         logging.error('Произошла ошибка: %s', e)
-        connection.rollback()
+        if connection:
+            connection.rollback()
 
     finally:
         if connection:
-            connection.close()
+            release_db_connection(connection)